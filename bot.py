@@ -1,43 +1,104 @@
 import os
+import sys
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
 import random
+import secrets
 import string
-from datetime import datetime
+import copy
+import contextlib
+import time
+import threading
+from datetime import datetime, date
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+from telegram.ext import AIORateLimiter, Application, SimpleUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import signal
+import atexit
 import asyncio
-import threading
-from flask import Flask
-# ========== FLASK SETUP ==========
-app = Flask(__name__)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+from aiohttp import web
+# ========== WEB SERVER SETUP ==========
+BOT_APPLICATION = web.AppKey("bot_application", Application)
+
+async def home(request):
+    return web.Response(text="✅ Telegram Bot is running on Koyeb")
 
-@app.route('/')
-def home():
-    return "✅ Telegram Bot is running on Koyeb"
+async def health(request):
+    return web.Response(text="OK")
+
+async def telegram_webhook(request):
+    """Hand an incoming Telegram update to the bot application"""
+    # Reject forged requests before spending time on parsing them
+    secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode("utf-8", "replace")
+    if not secrets.compare_digest(secret, WEBHOOK_SECRET.encode()):
+        return web.Response(status=403)
+    
+    application = request.app[BOT_APPLICATION]
+    if application.update_processor.pending >= MAX_PENDING_UPDATES:
+        # Telegram retries non-2xx deliveries later, which gives us back-pressure
+        return web.Response(status=429)
+    
+    try:
+        update = Update.de_json(json_loads(await request.read()), application.bot)
+    except (AttributeError, KeyError, TypeError, ValueError):
+        update = None
+    if not update:
+        # Passed the secret check but isn't a valid update ({}, null, garbage):
+        # a bad request, not a 500, and nothing to queue
+        return web.Response(status=400)
+    application.update_processor.pending += 1
+    application.update_queue.put_nowait(update)
+    return web.Response()
 
-@app.route('/health')
-def health():
-    return "OK", 200
+app = web.Application()
+app.router.add_get('/', home)
+app.router.add_get('/health', health)
 
-def run_flask():
-    """Run Flask web server for health checks"""
-    port = int(os.getenv('PORT', 8080))
-    print(f"🌐 Starting Flask server on port {port}")
-    app.run(host='0.0.0.0', port=port, debug=False, use_reloader=False)
+async def start_web_server(application):
+    """Serve health checks and the Telegram webhook on the bot's event loop"""
+    app[BOT_APPLICATION] = application
+    app.router.add_post(f'/{TELEGRAM_BOT_TOKEN}', telegram_webhook)
+    
+    logger.info(f"🌐 Starting web server on port {PORT}")
+    # No per-request access log: health probes and webhook POSTs would flood it
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    return runner
 
 # ========== BOT CONFIGURATION ==========
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Handlers only enqueue log records, a listener thread does the actual writes
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = QueueListener(log_queue, log_stream_handler)
+log_queue_handler = QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[log_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # ========= ENVIRONMENT VARIABLES ==========
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 GITHUB_TOKEN = os.getenv("GITHUB_TOKEN")
+KOYEB_APP_NAME = os.getenv("KOYEB_APP_NAME")  # You MUST add this in Koyeb Secrets
+PORT = int(os.getenv("PORT", 8080))
 
 # Safety checks
 if not TELEGRAM_BOT_TOKEN:
@@ -45,107 +106,232 @@ if not TELEGRAM_BOT_TOKEN:
 
 if not GITHUB_TOKEN:
     raise Exception("❌ GITHUB_TOKEN is missing! Set it in Koyeb.")
+
+if not KOYEB_APP_NAME:
+    raise Exception("❌ Missing KOYEB_APP_NAME in Koyeb Secrets!")
+
+WEBHOOK_URL = f"https://{KOYEB_APP_NAME}.koyeb.app/{TELEGRAM_BOT_TOKEN}"
 GITHUB_REPO_OWNER = "WolfT31"
 GITHUB_REPO_NAME = "SPORTVIP"
 GITHUB_FILE_PATH = "Users.json"
 DEFAULT_DATE = "2025-12-12"
+MAX_INPUT_LENGTH = 128
+MAX_PENDING_UPDATES = 2000
+# Telegram echoes this back in X-Telegram-Bot-Api-Secret-Token on every webhook call
+WEBHOOK_SECRET = secrets.token_urlsafe(32)
+GITHUB_CONTENTS_URL = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/contents/{GITHUB_FILE_PATH}"
+GH_HEADERS_JSON = {
+    "Authorization": f"token {GITHUB_TOKEN}",
+    "Accept": "application/vnd.github.v3+json"
+}
+
+# Shared GitHub session so TCP/TLS connections are reused between calls
+gh_session = requests.Session()
+gh_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    # Only idempotent requests are retried: a PUT that GitHub committed before
+    # answering 5xx would come back as a 409 and get its change applied twice
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=frozenset({"GET", "HEAD"})
+    )
+))
+gh_session.headers.update(GH_HEADERS_JSON)
+gh_session.headers["Accept-Encoding"] = "gzip, deflate"
+
+# In-process cache of Users.json so repeated reads skip the GitHub round-trip
+_users_cache = None
+_users_cache_ts = 0.0
+_users_etag = None
+_users_sha = None
+_USERS_TTL = 30.0
+_users_in_flight = None
+_users_generation = 0
+# load_users/save_users run in worker threads; this keeps the cached list,
+# its SHA/ETag and the generation check consistent with each other
+_users_lock = threading.Lock()
 
 # Store user states for conversation flow
 user_states = {}
+STATE_TTL = 600
+STATE_CLEANUP_INTERVAL = 60
+
+# Per-user locks keep each conversation's state changes atomic,
+# the write lock serializes load -> modify -> save cycles on Users.json
+user_locks = {}
+gh_write_lock = asyncio.Lock()
+
+@contextlib.asynccontextmanager
+async def user_lock(user_id):
+    """Hold the lock guarding a user's conversation state"""
+    # [lock, holders + waiters]; the entry lives only while someone uses it,
+    # so an idle user's lock can never be handed out twice
+    entry = user_locks.get(user_id)
+    if entry is None:
+        entry = user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del user_locks[user_id]
+
+async def cleanup_states():
+    """Periodically drop conversations that were abandoned for STATE_TTL seconds"""
+    global user_states
+    while True:
+        await asyncio.sleep(STATE_CLEANUP_INTERVAL)
+        now = time.monotonic()
+        # Never evict a conversation whose handler is still running (or queued)
+        user_states = {
+            uid: state for uid, state in user_states.items()
+            if now - state.get('_ts', 0) < STATE_TTL or uid in user_locks
+        }
 
 # ========== GITHUB FUNCTIONS ==========
-def load_users():
+def json_loads(data):
+    """Parse JSON text/bytes, using orjson when it's installed"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps_bytes(obj):
+    """Serialize to indented UTF-8 JSON bytes, using orjson when it's installed"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+def _cache_users(users, sha, etag=None, generation=None):
     """
-    Load users from GitHub JSON file
-    Returns: List of users or empty list if error
+    Remember the latest users list with the blob SHA (and ETag) it was read or saved at
+    A load passes the generation it started at and is dropped if a save landed since,
+    a save (generation=None) always wins and starts a new generation
     """
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3.raw"
-    }
-    url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/contents/{GITHUB_FILE_PATH}"
+    global _users_cache, _users_cache_ts, _users_etag, _users_sha, _users_generation
+    users = copy.deepcopy(users)
+    with _users_lock:
+        if generation is None:
+            _users_generation += 1
+        elif generation != _users_generation:
+            return
+        _users_cache = users
+        _users_cache_ts = time.monotonic()
+        _users_etag = etag
+        _users_sha = sha
+
+def _cached_users_or_none(users, sha):
+    """Fall back to the last users we loaded/saved while GitHub is unreachable"""
+    if users is not None:
+        logger.warning("⚠️ GitHub unavailable, serving cached users")
+        return copy.deepcopy(users), sha
+    return None, None
+
+def load_users_with_sha(fallback=True):
+    """
+    Load users from GitHub JSON file, together with the blob SHA they were read at
+    fallback=False skips the cached copy on GitHub errors (for saves, which must
+    never build on a possibly outdated list)
+    Returns: (users, sha) - users is None if they couldn't be loaded
+    """
+    global _users_cache_ts
+    with _users_lock:
+        # A save that lands while we're fetching makes our response stale
+        generation = _users_generation
+        cached, cached_sha, cached_etag = _users_cache, _users_sha, _users_etag
+        fresh = cached is not None and time.monotonic() - _users_cache_ts < _USERS_TTL
+    if fresh:
+        return copy.deepcopy(cached), cached_sha
+    
+    headers = None
+    if cached is not None and cached_etag:
+        # Conditional GET: a 304 doesn't count against the rate limit
+        headers = {"If-None-Match": cached_etag}
     
     try:
-        logger.info(f"📥 Loading users from GitHub: {url}")
-        response = requests.get(url, headers=headers, timeout=10)
+        logger.info(f"📥 Loading users from GitHub: {GITHUB_CONTENTS_URL}")
+        response = gh_session.get(GITHUB_CONTENTS_URL, headers=headers, timeout=10)
         
-        if response.status_code == 200:
+        if response.status_code == 304:
+            logger.info("✅ Users.json not modified, using cached users")
+            with _users_lock:
+                if generation == _users_generation:
+                    _users_cache_ts = time.monotonic()
+            return copy.deepcopy(cached), cached_sha
+        elif response.status_code == 200:
             try:
-                # Try to parse as JSON
-                data = json.loads(response.text)
+                # The contents API returns the file and its blob SHA in one response,
+                # so a later save always PUTs on top of exactly what we read
+                file_info = json_loads(response.content)
+                sha = file_info.get("sha")
+                data = json_loads(base64.b64decode(file_info.get("content", "")))
                 logger.info(f"✅ JSON parsed successfully, type: {type(data)}")
                 
                 # Your file contains a direct JSON array, so return it as is
                 if isinstance(data, list):
                     logger.info(f"✅ Successfully loaded {len(data)} users")
-                    return data
+                    _cache_users(data, sha, response.headers.get("ETag"), generation)
+                    return data, sha
                 elif isinstance(data, dict):
                     # If it's a dict with 'users' key
                     if "users" in data:
                         users_list = data.get("users", [])
                         logger.info(f"✅ Loaded {len(users_list)} users from dict")
-                        return users_list
+                        _cache_users(users_list, sha, response.headers.get("ETag"), generation)
+                        return users_list, sha
                     else:
                         # If dict without 'users' key, check if it's actually an array
                         logger.warning("⚠️ JSON is dict but no 'users' key found")
-                        return []
+                        return None, None
                 else:
                     logger.error(f"❌ Unexpected data type: {type(data)}")
-                    return []
+                    return None, None
                     
-            except json.JSONDecodeError as e:
+            except ValueError as e:
                 logger.error(f"❌ Failed to parse JSON: {e}")
                 logger.error(f"Response text (first 200 chars): {response.text[:200]}")
-                return []
+                return None, None
                 
         elif response.status_code == 404:
             logger.error("❌ Users.json file not found on GitHub!")
-            return []
+            return None, None
         else:
             logger.error(f"❌ GitHub API error (HTTP {response.status_code})")
             logger.error(f"Response: {response.text[:200]}")
-            return []
+            return _cached_users_or_none(cached, cached_sha) if fallback else (None, None)
             
     except requests.exceptions.RequestException as e:
         logger.error(f"❌ Network error loading users: {str(e)}")
-        return []
+        return _cached_users_or_none(cached, cached_sha) if fallback else (None, None)
     except Exception as e:
-        logger.error(f"❌ Unexpected error loading users: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return []
+        logger.exception(f"❌ Unexpected error loading users: {str(e)}")
+        return None, None
 
-def save_users(users):
+def load_users():
     """
-    Save users to GitHub JSON file
-    Returns: True if successful, False otherwise
+    Load users from GitHub JSON file
+    Returns: List of users, or None if they couldn't be loaded
     """
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/contents/{GITHUB_FILE_PATH}"
-    
+    return load_users_with_sha()[0]
+
+def save_users(users, sha):
+    """
+    Save users to GitHub JSON file, on top of the blob SHA they were loaded at
+    Returns: True if successful, None if Users.json changed since it was loaded, False otherwise
+    """
+    global _users_cache_ts, _users_etag, _users_generation
     try:
-        # First, try to get the existing file to get its SHA
-        logger.info("📤 Getting file SHA from GitHub...")
-        get_response = requests.get(url, headers=headers, timeout=10)
-        
-        sha = ""
-        if get_response.status_code == 200:
-            sha = get_response.json().get("sha", "")
-            logger.info(f"✅ Got file SHA: {sha[:20]}...")
-        elif get_response.status_code == 404:
-            logger.error("❌ File not found on GitHub. Cannot update.")
-            return False
-        else:
-            logger.error(f"❌ Failed to get file info (HTTP {get_response.status_code})")
-            logger.error(f"Error: {get_response.text[:200]}")
+        if not sha:
+            logger.error("❌ No file SHA for these users. Cannot update.")
             return False
 
         # Prepare the content
-        content = json.dumps(users, indent=2, ensure_ascii=False)
-        encoded_content = base64.b64encode(content.encode("utf-8")).decode("utf-8")
+        content = json_dumps_bytes(users)
+        encoded_content = base64.b64encode(content).decode("utf-8")
         
         # Prepare the commit data
         commit_data = {
@@ -157,33 +343,93 @@ def save_users(users):
         
         # Save to GitHub
         logger.info(f"💾 Uploading {len(users)} users to GitHub...")
-        put_response = requests.put(url, headers=headers, json=commit_data, timeout=15)
+        put_response = gh_session.put(GITHUB_CONTENTS_URL, json=commit_data, timeout=15)
+        
+        if put_response.status_code == 409:
+            # Someone else committed since we loaded; PUTting this list again would
+            # overwrite their change, so force a full reload (readers may still
+            # fall back to the old copy, saves never do)
+            logger.warning("⚠️ Users.json changed on GitHub, reload before saving again")
+            with _users_lock:
+                _users_cache_ts = 0.0
+                _users_etag = None
+                _users_generation += 1
+            return None
         
         if put_response.status_code in [200, 201]:
             logger.info("✅ Successfully saved users to GitHub")
+            # The saved list is now the freshest copy; the old ETag no longer applies
+            _cache_users(users, put_response.json().get("content", {}).get("sha"))
             return True
         else:
             error_msg = put_response.text[:500] if put_response.text else "No error message"
             logger.error(f"❌ Failed to save to GitHub (HTTP {put_response.status_code})")
             logger.error(f"Error: {error_msg}")
+            # Cached users may be stale, revalidate them next time
+            _users_cache_ts = 0.0
             return False
             
     except requests.exceptions.RequestException as e:
         logger.error(f"❌ Network error saving users: {str(e)}")
         return False
     except Exception as e:
-        logger.error(f"❌ Unexpected error saving users: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Unexpected error saving users: {str(e)}")
         return False
 
+def _clear_users_in_flight(task):
+    global _users_in_flight
+    _users_in_flight = None
+
+async def aload_users():
+    """
+    Run load_users in a worker thread so the event loop stays responsive
+    Concurrent callers share a single in-flight GitHub fetch
+    """
+    global _users_in_flight
+    if _users_cache is not None and time.monotonic() - _users_cache_ts < _USERS_TTL:
+        return copy.deepcopy(_users_cache)
+    
+    if _users_in_flight is None:
+        _users_in_flight = asyncio.create_task(asyncio.to_thread(load_users))
+        _users_in_flight.add_done_callback(_clear_users_in_flight)
+    
+    # Shield so one cancelled caller doesn't cancel the fetch for everyone else
+    users = await asyncio.shield(_users_in_flight)
+    return copy.deepcopy(users)
+
+async def asave_users(users, sha):
+    """Run save_users in a worker thread so the event loop stays responsive"""
+    return await asyncio.to_thread(save_users, users, sha)
+
+async def aupdate_users(change):
+    """
+    Load users, apply change(users) and save them back, holding gh_write_lock
+    change edits the list in place, returning False skips the save
+    If Users.json changed on GitHub meanwhile, change is reapplied once to a fresh copy
+    Returns: (users, saved) - saved is True/False, or None if change skipped the save;
+    users is None (and nothing is saved) if Users.json couldn't be loaded
+    """
+    async with gh_write_lock:
+        for attempt in range(2):
+            # Users and SHA come from one read, never PUT a list on another read's SHA
+            users, sha = await asyncio.to_thread(load_users_with_sha, False)
+            if users is None:
+                # Never save on top of a failed load
+                return None, False
+            if change(users) is False:
+                return users, None
+            saved = await asave_users(users, sha)
+            if saved is not None:
+                return users, saved
+        return users, False
+
 # ========== HELPER FUNCTIONS ==========
+_ALNUM = string.ascii_letters + string.digits
+_LOWER_DIGIT = string.ascii_lowercase + string.digits
+
 def generate_random_password(length=4):
     """Generate a random password"""
-    if length > 4:
-        length = 4
-    characters = string.ascii_letters + string.digits
-    return ''.join(random.choice(characters) for _ in range(length))
+    return ''.join(random.choices(_ALNUM, k=min(length, 4)))
 
 def generate_random_username():
     """Generate a random username"""
@@ -191,23 +437,25 @@ def generate_random_username():
     max_suffix_length = 8 - len(prefix)
     if max_suffix_length <= 0:
         return prefix[:8]
-    suffix = ''.join(random.choice(string.ascii_lowercase + string.digits) for _ in range(max_suffix_length))
-    return prefix + suffix
+    return prefix + ''.join(random.choices(_LOWER_DIGIT, k=max_suffix_length))
 
-def get_days_left(expire_str):
+def get_days_left(expire_str, today=None):
     """Calculate days until expiration"""
-    try:
-        expire_date = datetime.strptime(expire_str, "%Y-%m-%d").date()
+    if today is None:
         today = datetime.now().date()
+    try:
+        # Fast path for the usual YYYY-MM-DD, strptime for anything else
+        if len(expire_str) == 10:
+            expire_date = date(int(expire_str[:4]), int(expire_str[5:7]), int(expire_str[8:10]))
+        else:
+            expire_date = datetime.strptime(expire_str, "%Y-%m-%d").date()
         days = (expire_date - today).days
         return days
     except Exception:
         return -999
 
-# ========== TELEGRAM HANDLERS ==========
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Send a welcome message when the command /start is issued."""
-    welcome_text = """
+# ========== MESSAGES & KEYBOARDS ==========
+WELCOME_TEXT = """
 🏆 *ADMIN PANEL SERVER BOT* 🏆
 
 *habari kiongozi mimi ni bot wa kukusaidia kusajiri na kumanage accounts zote za app ya aviator*
@@ -222,20 +470,67 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
       𝚃𝚞𝚖𝚒𝚊 𝙱𝚞𝚝𝚝𝚘𝚗 𝚊𝚞 𝙲𝚘𝚖𝚖𝚊𝚗𝚍𝚜
 """
-    
-    keyboard = [
-        [InlineKeyboardButton("➕ Add User", callback_data='add_user')],
-        [InlineKeyboardButton("🗑️ Remove User", callback_data='remove_user')],
-        [InlineKeyboardButton("📋 List Users", callback_data='list_users')],
-        [InlineKeyboardButton("ℹ️ Help", callback_data='help')],
-        [InlineKeyboardButton("🔍 Debug", callback_data='debug')]
+
+MAIN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Add User", callback_data='add_user')],
+    [InlineKeyboardButton("🗑️ Remove User", callback_data='remove_user')],
+    [InlineKeyboardButton("📋 List Users", callback_data='list_users')],
+    [InlineKeyboardButton("ℹ️ Help", callback_data='help')],
+    [InlineKeyboardButton("🔍 Debug", callback_data='debug')]
+])
+
+CANCEL_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data='cancel')]])
+
+OFFLINE_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Yes", callback_data='offline_yes'),
+        InlineKeyboardButton("❌ No", callback_data='offline_no')
+    ],
+    [InlineKeyboardButton("❌ Cancel", callback_data='cancel')]
+])
+
+CONFIRM_REMOVE_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Yes, Remove", callback_data='confirm_remove'),
+        InlineKeyboardButton("❌ Cancel", callback_data='cancel')
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+])
+
+CONFIRM_REMOVE_ALL_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Yes, Remove All", callback_data='confirm_remove_all'),
+        InlineKeyboardButton("❌ Cancel", callback_data='cancel')
+    ]
+])
+
+ADD_ANYWAY_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Yes, Add Anyway", callback_data='add_anyway'),
+        InlineKeyboardButton("❌ Cancel", callback_data='cancel')
+    ]
+])
+
+USAGE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("➕ Add User", callback_data='add_user')],
+    [InlineKeyboardButton("🗑️ Remove User", callback_data='remove_user')],
+    [InlineKeyboardButton("📋 List Users", callback_data='list_users')],
+    [InlineKeyboardButton("ℹ️ Help", callback_data='help')]
+])
+
+LIST_USERS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Back to Menu", callback_data='menu')],
+    [InlineKeyboardButton("🔄 Refresh", callback_data='list_users')]
+])
+
+BACK_TO_MENU_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Back to Menu", callback_data='menu')]])
+
+# ========== TELEGRAM HANDLERS ==========
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a welcome message when the command /start is issued."""
     await update.message.reply_text(
-        welcome_text,
+        WELCOME_TEXT,
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=MAIN_KEYBOARD
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -269,27 +564,16 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Debug command to check bot status"""
-    # Test GitHub connection
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/contents/{GITHUB_FILE_PATH}"
-    
+    # Test GitHub connection (HEAD: no body download, no test commit to the repo)
     try:
-        response = requests.get(url, headers=headers, timeout=5)
+        response = await asyncio.to_thread(gh_session.head, GITHUB_CONTENTS_URL, timeout=5)
         file_exists = response.status_code == 200
         file_status = response.status_code
+        token_scopes = response.headers.get("X-OAuth-Scopes") or "N/A"
         
         # Load users to count them
-        users = load_users()
-        user_count = len(users)
-        
-        # Test save with current data
-        test_save = False
-        if users:
-            # Try to save the same data back
-            test_save = save_users(users)
+        users = await aload_users()
+        user_count = len(users) if users is not None else "N/A"
         
         debug_text = f"""
 🔍 *BOT DEBUG INFORMATION*
@@ -299,7 +583,7 @@ async def debug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • File: `{GITHUB_FILE_PATH}`
 • File Exists: `{file_exists}` (Status: {file_status})
 • Users Loaded: `{user_count}` users
-• Save Test: `{"✅ Success" if test_save else "❌ Failed"}`
+• Token Scopes: `{token_scopes}`
 
 *Bot Status:*
 • State Storage: `{len(user_states)}` active conversations
@@ -329,274 +613,243 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     
     user_id = query.from_user.id
-    
-    if query.data == 'add_user':
-        user_states[user_id] = {'state': 'awaiting_device_id'}
-        await query.edit_message_text(
-            "Please enter the *Device ID*:",
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == 'remove_user':
-        user_states[user_id] = {'state': 'awaiting_remove_username'}
-        await query.edit_message_text(
-            "Please enter the *Username* to remove:",
-            parse_mode='Markdown'
-        )
-    
-    elif query.data == 'list_users':
-        await list_users_command(update, context, query=query)
-    
-    elif query.data == 'help':
-        await help_command(update, context)
-        # Keep the original message with buttons
-        await query.edit_message_text(
-            query.message.text,
-            parse_mode='Markdown',
-            reply_markup=query.message.reply_markup
-        )
-    
-    elif query.data == 'debug':
-        await debug_command(update, context)
-    
-    elif query.data == 'cancel':
-        if user_id in user_states:
-            user_states.pop(user_id, None)
-        await query.edit_message_text(
-            "Operation cancelled. Use /start to see menu again.",
-            parse_mode='Markdown'
-        )
+    async with user_lock(user_id):
+        if query.data == 'add_user':
+            user_states[user_id] = {'state': 'awaiting_device_id', '_ts': time.monotonic()}
+            await query.edit_message_text(
+                "Please enter the *Device ID*:",
+                parse_mode='Markdown'
+            )
+        
+        elif query.data == 'remove_user':
+            user_states[user_id] = {'state': 'awaiting_remove_username', '_ts': time.monotonic()}
+            await query.edit_message_text(
+                "Please enter the *Username* to remove:",
+                parse_mode='Markdown'
+            )
+        
+        elif query.data == 'list_users':
+            await list_users_command(update, context, query=query)
+        
+        elif query.data == 'help':
+            await help_command(update, context)
+            # Keep the original message with buttons
+            await query.edit_message_text(
+                query.message.text,
+                parse_mode='Markdown',
+                reply_markup=query.message.reply_markup
+            )
+        
+        elif query.data == 'debug':
+            await debug_command(update, context)
+        
+        elif query.data == 'cancel':
+            if user_id in user_states:
+                user_states.pop(user_id, None)
+            await query.edit_message_text(
+                "Operation cancelled. Use /start to see menu again.",
+                parse_mode='Markdown'
+            )
 
 async def add_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the add user process."""
     user_id = update.effective_user.id
-    user_states[user_id] = {'state': 'awaiting_device_id'}
-    
-    keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data='cancel')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "Let's add a new user.\n\nPlease enter the *Device ID*:",
-        parse_mode='Markdown',
-        reply_markup=reply_markup
-    )
+    async with user_lock(user_id):
+        user_states[user_id] = {'state': 'awaiting_device_id', '_ts': time.monotonic()}
+        
+        await update.message.reply_text(
+            "Let's add a new user.\n\nPlease enter the *Device ID*:",
+            parse_mode='Markdown',
+            reply_markup=CANCEL_KEYBOARD
+        )
 
 async def remove_user_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start the remove user process."""
     user_id = update.effective_user.id
-    user_states[user_id] = {'state': 'awaiting_remove_username'}
-    
-    keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data='cancel')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await update.message.reply_text(
-        "Please enter the *Username* to remove:",
-        parse_mode='Markdown',
-        reply_markup=reply_markup
-    )
+    async with user_lock(user_id):
+        user_states[user_id] = {'state': 'awaiting_remove_username', '_ts': time.monotonic()}
+        
+        await update.message.reply_text(
+            "Please enter the *Username* to remove:",
+            parse_mode='Markdown',
+            reply_markup=CANCEL_KEYBOARD
+        )
 
 async def list_users_command(update: Update, context: ContextTypes.DEFAULT_TYPE, query=None):
     """List all users."""
-    users = load_users()
+    users = await aload_users()
     
-    if not users:
+    if users is None:
+        text = "❌ Couldn't load users from GitHub.\n\nUse /debug to check bot status."
+    elif not users:
         text = "📭 *No approved users yet.*\n\nUse /add to add your first user."
     else:
-        text = f"📋 *APPROVED USERS* ({len(users)} total)\n\n"
+        lines = [f"📋 *APPROVED USERS* ({len(users)} total)", ""]
+        today = datetime.now().date()
         for i, user in enumerate(users, 1):
-            days_left = get_days_left(user.get('expiresAt', DEFAULT_DATE))
+            days_left = get_days_left(user.get('expiresAt', DEFAULT_DATE), today)
             status = "✅" if days_left > 0 else "❌"
             
-            text += f"*User #{i}*\n"
-            text += f"{status} *ID:* `{user.get('id', 'N/A')}`\n"
-            text += f"👤 *Username:* `{user.get('username', 'N/A')}`\n"
-            text += f"🔑 *Password:* `{user.get('password', 'N/A')}`\n"
-            text += f"📅 *Expires:* `{user.get('expiresAt', DEFAULT_DATE)}` "
-            text += f"({days_left} days left)\n"
-            text += f"💾 *Offline Access:* `{user.get('allowOffline', False)}`\n"
-            text += "━" * 20 + "\n"
-    
-    keyboard = [
-        [InlineKeyboardButton("🔙 Back to Menu", callback_data='menu')],
-        [InlineKeyboardButton("🔄 Refresh", callback_data='list_users')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+            lines.extend([
+                f"*User #{i}*",
+                f"{status} *ID:* `{user.get('id', 'N/A')}`",
+                f"👤 *Username:* `{user.get('username', 'N/A')}`",
+                f"🔑 *Password:* `{user.get('password', 'N/A')}`",
+                f"📅 *Expires:* `{user.get('expiresAt', DEFAULT_DATE)}` ({days_left} days left)",
+                f"💾 *Offline Access:* `{user.get('allowOffline', False)}`",
+                "━" * 20
+            ])
+        text = "\n".join(lines)
     
     if query:
-        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=LIST_USERS_KEYBOARD)
     else:
-        await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+        await update.message.reply_text(text, parse_mode='Markdown', reply_markup=LIST_USERS_KEYBOARD)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle user messages based on state."""
     user_id = update.effective_user.id
     message_text = update.message.text.strip()
     
-    if user_id not in user_states:
-        keyboard = [
-            [InlineKeyboardButton("➕ Add User", callback_data='add_user')],
-            [InlineKeyboardButton("🗑️ Remove User", callback_data='remove_user')],
-            [InlineKeyboardButton("📋 List Users", callback_data='list_users')],
-            [InlineKeyboardButton("ℹ️ Help", callback_data='help')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(
-            "Please use the buttons or commands to interact with the bot.",
-            reply_markup=reply_markup
-        )
-        return
-    
-    state = user_states[user_id]['state']
-    
-    if state == 'awaiting_device_id':
-        user_states[user_id]['device_id'] = message_text
-        user_states[user_id]['state'] = 'awaiting_username'
-        await update.message.reply_text(
-            "Great! Now enter the *Username*:",
-            parse_mode='Markdown'
-        )
-    
-    elif state == 'awaiting_username':
-        user_states[user_id]['username'] = message_text
-        user_states[user_id]['state'] = 'awaiting_password'
-        await update.message.reply_text(
-            "Now enter the *Password*:",
-            parse_mode='Markdown'
-        )
-    
-    elif state == 'awaiting_password':
-        user_states[user_id]['password'] = message_text
-        user_states[user_id]['state'] = 'awaiting_expiration'
-        await update.message.reply_text(
-            f"⏳ Enter *Expiration Date* (YYYY-MM-DD):\nExample: `{DEFAULT_DATE}`",
-            parse_mode='Markdown'
-        )
-    
-    elif state == 'awaiting_expiration':
-        expiresAt = message_text if message_text else DEFAULT_DATE
-        try:
-            datetime.strptime(expiresAt, "%Y-%m-%d")
-            user_states[user_id]['expiresAt'] = expiresAt
-            user_states[user_id]['state'] = 'awaiting_offline'
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Yes", callback_data='offline_yes'),
-                    InlineKeyboardButton("❌ No", callback_data='offline_no')
-                ],
-                [InlineKeyboardButton("❌ Cancel", callback_data='cancel')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
+    async with user_lock(user_id):
+        if user_id not in user_states:
             await update.message.reply_text(
-                "Allow *Offline Access*?",
-                parse_mode='Markdown',
-                reply_markup=reply_markup
+                "Please use the buttons or commands to interact with the bot.",
+                reply_markup=USAGE_KEYBOARD
             )
-        except ValueError:
+            return
+        
+        state = user_states[user_id]['state']
+        user_states[user_id]['_ts'] = time.monotonic()
+        
+        if state in ('awaiting_device_id', 'awaiting_username', 'awaiting_password') and len(message_text) > MAX_INPUT_LENGTH:
+            await update.message.reply_text(f"❌ Too long (max {MAX_INPUT_LENGTH} chars). Try again:")
+            return
+        
+        if state == 'awaiting_device_id':
+            user_states[user_id]['device_id'] = message_text
+            user_states[user_id]['state'] = 'awaiting_username'
             await update.message.reply_text(
-                "❌ Invalid date format. Please use YYYY-MM-DD. Try again:"
+                "Great! Now enter the *Username*:",
+                parse_mode='Markdown'
             )
-    
-    elif state == 'awaiting_remove_username':
-        username = message_text
-        users = load_users()
         
-        if not users:
-            await update.message.reply_text("❌ No users found in database.")
-            user_states.pop(user_id, None)
-            return
+        elif state == 'awaiting_username':
+            user_states[user_id]['username'] = message_text
+            user_states[user_id]['state'] = 'awaiting_password'
+            await update.message.reply_text(
+                "Now enter the *Password*:",
+                parse_mode='Markdown'
+            )
         
-        matching_users = [user for user in users if user.get("username") == username]
+        elif state == 'awaiting_password':
+            user_states[user_id]['password'] = message_text
+            user_states[user_id]['state'] = 'awaiting_expiration'
+            await update.message.reply_text(
+                f"⏳ Enter *Expiration Date* (YYYY-MM-DD):\nExample: `{DEFAULT_DATE}`",
+                parse_mode='Markdown'
+            )
         
-        if not matching_users:
-            await update.message.reply_text(f"❌ User with username '{username}' not found.")
-            user_states.pop(user_id, None)
-            return
+        elif state == 'awaiting_expiration':
+            expiresAt = message_text if message_text else DEFAULT_DATE
+            try:
+                datetime.strptime(expiresAt, "%Y-%m-%d")
+                user_states[user_id]['expiresAt'] = expiresAt
+                user_states[user_id]['state'] = 'awaiting_offline'
+                
+                await update.message.reply_text(
+                    "Allow *Offline Access*?",
+                    parse_mode='Markdown',
+                    reply_markup=OFFLINE_KEYBOARD
+                )
+            except ValueError:
+                await update.message.reply_text(
+                    "❌ Invalid date format. Please use YYYY-MM-DD. Try again:"
+                )
         
-        if len(matching_users) > 1:
-            text = f"Found *{len(matching_users)}* users with username '{username}':\n\n"
-            for i, user in enumerate(matching_users, 1):
-                text += f"*Option {i}:*\n"
-                text += f"Device ID: `{user.get('id', 'N/A')}`\n"
-                text += f"Username: `{user.get('username', 'N/A')}`\n"
-                text += f"Expiration: `{user.get('expiresAt', DEFAULT_DATE)}`\n\n"
+        elif state == 'awaiting_remove_username':
+            username = message_text
+            users = await aload_users()
             
-            text += "Enter the number to remove, or type 'all' to remove all:"
+            if users is None:
+                await update.message.reply_text("❌ Couldn't load users from GitHub. Use /debug to check bot status.")
+                user_states.pop(user_id, None)
+                return
             
-            user_states[user_id]['remove_username'] = username
-            user_states[user_id]['matching_users'] = matching_users
-            user_states[user_id]['state'] = 'awaiting_remove_choice'
+            if not users:
+                await update.message.reply_text("❌ No users found in database.")
+                user_states.pop(user_id, None)
+                return
             
-            await update.message.reply_text(text, parse_mode='Markdown')
-        else:
-            user = matching_users[0]
-            user_states[user_id]['remove_user'] = user
-            user_states[user_id]['state'] = 'confirm_remove_single'
+            matching_users = [user for user in users if user.get("username") == username]
             
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Yes, Remove", callback_data='confirm_remove'),
-                    InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            text = f"Found user:\n\n"
-            text += f"ID: `{user.get('id', 'N/A')}`\n"
-            text += f"Username: `{user.get('username', 'N/A')}`\n"
-            text += f"Expiration: `{user.get('expiresAt', DEFAULT_DATE)}`\n\n"
-            text += "Are you sure you want to remove this user?"
-            
-            await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
-    
-    elif state == 'awaiting_remove_choice':
-        choice = message_text.lower()
-        
-        if choice == 'all':
-            user_states[user_id]['state'] = 'confirm_remove_all'
+            if not matching_users:
+                await update.message.reply_text(f"❌ User with username '{username}' not found.")
+                user_states.pop(user_id, None)
+                return
             
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Yes, Remove All", callback_data='confirm_remove_all'),
-                    InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await update.message.reply_text(
-                f"⚠️ Are you sure you want to remove ALL users with username '{user_states[user_id]['remove_username']}'?",
-                reply_markup=reply_markup
-            )
-        elif choice.isdigit():
-            idx = int(choice) - 1
-            matching_users = user_states[user_id]['matching_users']
-            
-            if 0 <= idx < len(matching_users):
-                user_states[user_id]['remove_user'] = matching_users[idx]
-                user_states[user_id]['state'] = 'confirm_remove_single'
+            if len(matching_users) > 1:
+                lines = [f"Found *{len(matching_users)}* users with username '{username}':", ""]
+                for i, user in enumerate(matching_users, 1):
+                    lines.extend([
+                        f"*Option {i}:*",
+                        f"Device ID: `{user.get('id', 'N/A')}`",
+                        f"Username: `{user.get('username', 'N/A')}`",
+                        f"Expiration: `{user.get('expiresAt', DEFAULT_DATE)}`",
+                        ""
+                    ])
                 
-                keyboard = [
-                    [
-                        InlineKeyboardButton("✅ Yes, Remove", callback_data='confirm_remove'),
-                        InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                    ]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                lines.append("Enter the number to remove, or type 'all' to remove all:")
+                text = "\n".join(lines)
+                
+                user_states[user_id]['remove_username'] = username
+                user_states[user_id]['matching_users'] = matching_users
+                user_states[user_id]['state'] = 'awaiting_remove_choice'
+                
+                await update.message.reply_text(text, parse_mode='Markdown')
+            else:
+                user = matching_users[0]
+                user_states[user_id]['remove_key'] = (user.get('id'), user.get('username'))
+                user_states[user_id]['state'] = 'confirm_remove_single'
                 
-                user = matching_users[idx]
-                text = f"Selected user:\n\n"
+                text = f"Found user:\n\n"
                 text += f"ID: `{user.get('id', 'N/A')}`\n"
                 text += f"Username: `{user.get('username', 'N/A')}`\n"
                 text += f"Expiration: `{user.get('expiresAt', DEFAULT_DATE)}`\n\n"
                 text += "Are you sure you want to remove this user?"
                 
-                await update.message.reply_text(text, parse_mode='Markdown', reply_markup=reply_markup)
+                await update.message.reply_text(text, parse_mode='Markdown', reply_markup=CONFIRM_REMOVE_KEYBOARD)
+        
+        elif state == 'awaiting_remove_choice':
+            choice = message_text.lower()
+            
+            if choice == 'all':
+                user_states[user_id]['state'] = 'confirm_remove_all'
+                
+                await update.message.reply_text(
+                    f"⚠️ Are you sure you want to remove ALL users with username '{user_states[user_id]['remove_username']}'?",
+                    reply_markup=CONFIRM_REMOVE_ALL_KEYBOARD
+                )
+            elif choice.isdigit():
+                idx = int(choice) - 1
+                matching_users = user_states[user_id]['matching_users']
+                
+                if 0 <= idx < len(matching_users):
+                    user_states[user_id]['remove_key'] = (matching_users[idx].get('id'), matching_users[idx].get('username'))
+                    user_states[user_id]['state'] = 'confirm_remove_single'
+                    
+                    user = matching_users[idx]
+                    text = f"Selected user:\n\n"
+                    text += f"ID: `{user.get('id', 'N/A')}`\n"
+                    text += f"Username: `{user.get('username', 'N/A')}`\n"
+                    text += f"Expiration: `{user.get('expiresAt', DEFAULT_DATE)}`\n\n"
+                    text += "Are you sure you want to remove this user?"
+                    
+                    await update.message.reply_text(text, parse_mode='Markdown', reply_markup=CONFIRM_REMOVE_KEYBOARD)
+                else:
+                    await update.message.reply_text("❌ Invalid choice. Please try again.")
             else:
-                await update.message.reply_text("❌ Invalid choice. Please try again.")
-        else:
-            await update.message.reply_text("❌ Invalid input. Please enter a number or 'all'.")
+                await update.message.reply_text("❌ Invalid input. Please enter a number or 'all'.")
 
 async def handle_offline_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle offline access choice."""
@@ -604,60 +857,63 @@ async def handle_offline_callback(update: Update, context: ContextTypes.DEFAULT_
     await query.answer()
     
     user_id = query.from_user.id
-    
-    if user_id not in user_states or user_states[user_id].get('state') != 'awaiting_offline':
-        return
-    
-    if query.data == 'offline_yes':
-        allowOffline = True
-    elif query.data == 'offline_no':
-        allowOffline = False
-    else:
-        return
-    
-    user_data = user_states[user_id]
-    
-    try:
-        users = load_users()
-        
-        # Check for duplicates
-        duplicate = any(
-            user.get("username") == user_data['username'] and 
-            user.get("password") == user_data['password'] 
-            for user in users
-        )
-        
-        if duplicate:
-            keyboard = [
-                [
-                    InlineKeyboardButton("✅ Yes, Add Anyway", callback_data='add_anyway'),
-                    InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            user_states[user_id]['allowOffline'] = allowOffline
-            user_states[user_id]['state'] = 'confirm_duplicate'
-            
-            await query.edit_message_text(
-                "⚠️ This username/password combination already exists.\n\nDo you want to add it anyway?",
-                reply_markup=reply_markup
-            )
+    async with user_lock(user_id):
+        if user_id not in user_states or user_states[user_id].get('state') != 'awaiting_offline':
             return
         
-        # Add new user
-        new_user = {
-            "id": user_data['device_id'],
-            "username": user_data['username'],
-            "password": user_data['password'],
-            "expiresAt": user_data['expiresAt'],
-            "allowOffline": allowOffline
-        }
+        if query.data == 'offline_yes':
+            allowOffline = True
+        elif query.data == 'offline_no':
+            allowOffline = False
+        else:
+            return
         
-        users.append(new_user)
+        user_data = user_states[user_id]
         
-        if save_users(users):
-            success_text = f"""
+        try:
+            # Add new user
+            new_user = {
+                "id": user_data['device_id'],
+                "username": user_data['username'],
+                "password": user_data['password'],
+                "expiresAt": user_data['expiresAt'],
+                "allowOffline": allowOffline
+            }
+            
+            def add_new_user(users):
+                # Check for duplicates
+                duplicate = any(
+                    user.get("username") == user_data['username'] and 
+                    user.get("password") == user_data['password'] 
+                    for user in users
+                )
+                if duplicate:
+                    return False
+                users.append(new_user)
+            
+            users, saved = await aupdate_users(add_new_user)
+            
+            if users is None:
+                await query.edit_message_text(
+                    "❌ Couldn't load users from GitHub, nothing was saved.\n\n"
+                    "Use /debug to check bot status."
+                )
+                user_states.pop(user_id, None)
+                return
+            
+            if saved is None:
+                user_states[user_id]['allowOffline'] = allowOffline
+                user_states[user_id]['state'] = 'confirm_duplicate'
+                user_states[user_id]['_ts'] = time.monotonic()
+                
+                await query.edit_message_text(
+                    "⚠️ This username/password combination already exists.\n\nDo you want to add it anyway?",
+                    reply_markup=ADD_ANYWAY_KEYBOARD
+                )
+                return
+            
+            if saved:
+                success_text = f"""
 ✅ *ACCOUNT CREATION SUCCESS*
 
 🆔 *Device ID:* `{user_data['device_id']}`
@@ -668,27 +924,24 @@ async def handle_offline_callback(update: Update, context: ContextTypes.DEFAULT_
 
 💠 *Total users in database: {len(users)}*
 """
-            
-            keyboard = [[InlineKeyboardButton("🏠 Back to Menu", callback_data='menu')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            await query.edit_message_text(success_text, parse_mode='Markdown', reply_markup=reply_markup)
-            user_states.pop(user_id, None)
-        else:
-            await query.edit_message_text(
-                "❌ Failed to save user to database.\n\n"
-                "Possible reasons:\n"
-                "1. GitHub token expired\n"
-                "2. No write permissions\n"
-                "3. Network issue\n\n"
-                "Use /debug to check bot status."
-            )
+                
+                await query.edit_message_text(success_text, parse_mode='Markdown', reply_markup=BACK_TO_MENU_KEYBOARD)
+                user_states.pop(user_id, None)
+            else:
+                await query.edit_message_text(
+                    "❌ Failed to save user to database.\n\n"
+                    "Possible reasons:\n"
+                    "1. GitHub token expired\n"
+                    "2. No write permissions\n"
+                    "3. Network issue\n\n"
+                    "Use /debug to check bot status."
+                )
+                user_states.pop(user_id, None)
+        
+        except Exception as e:
+            logger.error(f"Error adding user: {str(e)}")
+            await query.edit_message_text(f"❌ Error: {str(e)[:200]}")
             user_states.pop(user_id, None)
-            
-    except Exception as e:
-        logger.error(f"Error adding user: {str(e)}")
-        await query.edit_message_text(f"❌ Error: {str(e)[:200]}")
-        user_states.pop(user_id, None)
 
 async def handle_confirm_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle confirmation callbacks."""
@@ -696,48 +949,52 @@ async def handle_confirm_callback(update: Update, context: ContextTypes.DEFAULT_
     await query.answer()
     
     user_id = query.from_user.id
-    
-    if query.data == 'confirm_remove':
-        if user_id in user_states and user_states[user_id].get('state') == 'confirm_remove_single':
-            user_to_remove = user_states[user_id]['remove_user']
-            users = load_users()
-            users = [user for user in users if user != user_to_remove]
-            
-            if save_users(users):
-                await query.edit_message_text("✅ User successfully removed!")
-            else:
-                await query.edit_message_text("❌ Failed to remove user from database.")
-            
-            user_states.pop(user_id, None)
-    
-    elif query.data == 'confirm_remove_all':
-        if user_id in user_states and user_states[user_id].get('state') == 'confirm_remove_all':
-            username = user_states[user_id]['remove_username']
-            users = load_users()
-            users = [user for user in users if user.get("username") != username]
-            
-            if save_users(users):
-                await query.edit_message_text(f"✅ All users with username '{username}' successfully removed!")
-            else:
-                await query.edit_message_text("❌ Failed to remove users from database.")
-            
-            user_states.pop(user_id, None)
-    
-    elif query.data == 'add_anyway':
-        if user_id in user_states and user_states[user_id].get('state') == 'confirm_duplicate':
-            user_data = user_states[user_id]
-            
-            users = load_users()
-            users.append({
-                "id": user_data['device_id'],
-                "username": user_data['username'],
-                "password": user_data['password'],
-                "expiresAt": user_data['expiresAt'],
-                "allowOffline": user_data['allowOffline']
-            })
-            
-            if save_users(users):
-                success_text = f"""
+    async with user_lock(user_id):
+        if query.data == 'confirm_remove':
+            if user_id in user_states and user_states[user_id].get('state') == 'confirm_remove_single':
+                remove_key = user_states[user_id]['remove_key']
+                
+                def remove_user(users):
+                    users[:] = [user for user in users if (user.get('id'), user.get('username')) != remove_key]
+                
+                users, saved = await aupdate_users(remove_user)
+                if saved:
+                    await query.edit_message_text("✅ User successfully removed!")
+                else:
+                    await query.edit_message_text("❌ Failed to remove user from database.")
+                
+                user_states.pop(user_id, None)
+        
+        elif query.data == 'confirm_remove_all':
+            if user_id in user_states and user_states[user_id].get('state') == 'confirm_remove_all':
+                username = user_states[user_id]['remove_username']
+                
+                def remove_all_users(users):
+                    users[:] = [user for user in users if user.get("username") != username]
+                
+                users, saved = await aupdate_users(remove_all_users)
+                if saved:
+                    await query.edit_message_text(f"✅ All users with username '{username}' successfully removed!")
+                else:
+                    await query.edit_message_text("❌ Failed to remove users from database.")
+                
+                user_states.pop(user_id, None)
+        
+        elif query.data == 'add_anyway':
+            if user_id in user_states and user_states[user_id].get('state') == 'confirm_duplicate':
+                user_data = user_states[user_id]
+                
+                new_user = {
+                    "id": user_data['device_id'],
+                    "username": user_data['username'],
+                    "password": user_data['password'],
+                    "expiresAt": user_data['expiresAt'],
+                    "allowOffline": user_data['allowOffline']
+                }
+                
+                users, saved = await aupdate_users(lambda users: users.append(new_user))
+                if saved:
+                    success_text = f"""
 ✅ *ACCOUNT CREATED SUCCESSFULLY*
 
 🆔 *User ID:* `{user_data['device_id']}`
@@ -748,42 +1005,16 @@ async def handle_confirm_callback(update: Update, context: ContextTypes.DEFAULT_
 
 💠 *Coded by WOLF*
 """
-                keyboard = [[InlineKeyboardButton("🏠 Back to Menu", callback_data='menu')]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
+                    await query.edit_message_text(success_text, parse_mode='Markdown', reply_markup=BACK_TO_MENU_KEYBOARD)
+                else:
+                    await query.edit_message_text("❌ Failed to save user to database.")
                 
-                await query.edit_message_text(success_text, parse_mode='Markdown', reply_markup=reply_markup)
-            else:
-                await query.edit_message_text("❌ Failed to save user to database.")
-            
-            user_states.pop(user_id, None)
-    
-    elif query.data == 'menu':
-        welcome_text = """
-🏆 *ADMIN PANEL SERVER BOT* 🏆
-
-Karibu kwenye Database Management Bot!
-
-*Available Commands:*
-/start - Show this welcome message
-/add - Add new user
-/remove - Remove user
-/list - List all users
-/help - Show help information
-/debug - Check bot status
-"""
-        
-        keyboard = [
-            [InlineKeyboardButton("➕ Add User", callback_data='add_user')],
-            [InlineKeyboardButton("🗑️ Remove User", callback_data='remove_user')],
-            [InlineKeyboardButton("📋 List Users", callback_data='list_users')],
-            [InlineKeyboardButton("ℹ️ Help", callback_data='help')],
-            [InlineKeyboardButton("🔍 Debug", callback_data='debug')]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+                user_states.pop(user_id, None)
         
-        await query.edit_message_text(welcome_text, parse_mode='Markdown', reply_markup=reply_markup)
-        if user_id in user_states:
-            user_states.pop(user_id, None)
+        elif query.data == 'menu':
+            await query.edit_message_text(WELCOME_TEXT, parse_mode='Markdown', reply_markup=MAIN_KEYBOARD)
+            if user_id in user_states:
+                user_states.pop(user_id, None)
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Log errors."""
@@ -799,15 +1030,71 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
+# Button callback_data -> handler
+CALLBACK_HANDLERS = {
+    'add_user': button_handler,
+    'remove_user': button_handler,
+    'list_users': button_handler,
+    'help': button_handler,
+    'debug': button_handler,
+    'cancel': button_handler,
+    'offline_yes': handle_offline_callback,
+    'offline_no': handle_offline_callback,
+    'confirm_remove': handle_confirm_callback,
+    'confirm_remove_all': handle_confirm_callback,
+    'add_anyway': handle_confirm_callback,
+    'menu': handle_confirm_callback
+}
+
+async def dispatch_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Route a button press to its handler."""
+    await CALLBACK_HANDLERS[update.callback_query.data](update, context)
+
 # ========== APPLICATION SETUP ==========
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that decodes Bot API responses with orjson when available"""
+    
+    @staticmethod
+    def parse_json_payload(payload):
+        try:
+            return json_loads(payload)
+        except ValueError as exc:
+            raise TelegramError("Invalid server response") from exc
+
+class PendingUpdateProcessor(SimpleUpdateProcessor):
+    """SimpleUpdateProcessor that counts accepted updates until their handlers finish"""
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        # Incremented by telegram_webhook when it queues an update
+        self.pending = 0
+    
+    async def do_process_update(self, update, coroutine):
+        try:
+            await coroutine
+        finally:
+            self.pending -= 1
+
 async def setup_application():
     """Create and configure the bot application."""
     
+    # PTB turns every queued update into a task right away, so the webhook route
+    # caps how many are in flight (429 above MAX_PENDING_UPDATES). Within that cap
+    # every update runs concurrently: one waiting on user_lock/gh_write_lock never
+    # holds a slot another chat needs.
     application = Application.builder() \
         .token(TELEGRAM_BOT_TOKEN) \
-        .read_timeout(30.0) \
-        .connect_timeout(30.0) \
-        .pool_timeout(20.0) \
+        .updater(None) \
+        .concurrent_updates(PendingUpdateProcessor(MAX_PENDING_UPDATES)) \
+        .rate_limiter(AIORateLimiter(overall_max_rate=28, overall_time_period=1.0, max_retries=2)) \
+        .post_init(on_startup) \
+        .post_shutdown(on_shutdown) \
+        .request(OrjsonRequest(
+            connection_pool_size=256,
+            read_timeout=10.0,
+            connect_timeout=5.0,
+            pool_timeout=5.0
+        )) \
         .build()
     
     # Register all handlers
@@ -818,9 +1105,8 @@ async def setup_application():
     application.add_handler(CommandHandler("list", list_users_command))
     application.add_handler(CommandHandler("debug", debug_command))
     
-    application.add_handler(CallbackQueryHandler(button_handler, pattern='^(add_user|remove_user|list_users|help|debug|cancel)$'))
-    application.add_handler(CallbackQueryHandler(handle_offline_callback, pattern='^(offline_yes|offline_no)$'))
-    application.add_handler(CallbackQueryHandler(handle_confirm_callback, pattern='^(confirm_remove|confirm_remove_all|add_anyway|menu)$'))
+    # Callable pattern: a dict membership test instead of a regex match per update
+    application.add_handler(CallbackQueryHandler(dispatch_callback, pattern=CALLBACK_HANDLERS.__contains__))
     
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_error_handler(error_handler)
@@ -828,74 +1114,116 @@ async def setup_application():
     return application
 
 # ========== MAIN FUNCTION (WEBHOOK MODE FOR KOYEB) ==========
-async def main():
-    print("=" * 50)
-    print("🤖 STARTING BOT ON KOYEB USING WEBHOOKS")
-    print("=" * 50)
-    print(f"🔗 Bot token: {TELEGRAM_BOT_TOKEN[:10]}...")
-    print(f"🌐 GitHub Repo: {GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}")
-    print(f"📁 Data file: {GITHUB_FILE_PATH}")
-    print("⚡ Mode: Webhook")
-    print("=" * 50)
-
-    # Test GitHub connection
-    print("🔍 Testing GitHub connection...")
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    url = f"https://api.github.com/repos/{GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}/contents/{GITHUB_FILE_PATH}"
-
+async def check_github():
+    """Test the GitHub connection and preload users without blocking the loop"""
+    logger.info("🔍 Testing GitHub connection...")
     try:
-        response = requests.get(url, headers=headers, timeout=10)
+        # HEAD only; the file body is fetched once below and kept in the users cache
+        response = await asyncio.to_thread(gh_session.head, GITHUB_CONTENTS_URL, timeout=10)
         if response.status_code == 200:
-            print("✅ GitHub connection successful!")
-            users = load_users()
-            print(f"✅ Loaded {len(users)} existing users")
+            logger.info("✅ GitHub connection successful!")
+            users = await aload_users()
+            if users is None:
+                logger.error("❌ Couldn't load existing users")
+            else:
+                logger.info(f"✅ Loaded {len(users)} existing users")
         else:
-            print(f"❌ GitHub connection failed (HTTP {response.status_code})")
-            print(f"Error: {response.text[:200]}")
+            logger.error(f"❌ GitHub connection failed (HTTP {response.status_code})")
     except Exception as e:
-        print(f"❌ GitHub connection error: {str(e)}")
+        logger.error(f"❌ GitHub connection error: {str(e)}")
 
-    # Start Flask health server in background
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    print("✅ Flask health server started")
+async def on_startup(application):
+    """Bring up the web server, webhook and background jobs (post_init hook)"""
+    # One aiohttp server on this loop handles both health checks and webhook updates
+    application.bot_data['web_runner'] = await start_web_server(application)
+    logger.info("✅ Web server started")
 
-    # Build bot application
-    application = await setup_application()
+    logger.info(f"🌐 Setting webhook: {WEBHOOK_URL}")
 
-    # Webhook URL
-    KOYEB_APP = os.getenv("KOYEB_APP_NAME")  # You MUST add this in Koyeb Secrets
-    if not KOYEB_APP:
-        raise Exception("❌ Missing KOYEB_APP_NAME in Koyeb Secrets!")
+    # Test GitHub and set the webhook concurrently. Only ask for the update types
+    # we handle, and skip whatever queued up while the bot was down.
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(check_github())
+        tg.create_task(application.bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY],
+            drop_pending_updates=True,
+            max_connections=100
+        ))
 
-    webhook_url = f"https://{KOYEB_APP}.koyeb.app/{TELEGRAM_BOT_TOKEN}"
-    port = int(os.getenv("PORT", 8080))
+    # Evict abandoned conversations in the background
+    application.bot_data['cleanup_task'] = asyncio.create_task(cleanup_states())
 
-    print(f"🌐 Setting webhook: {webhook_url}")
+    logger.info("📡 Webhook set successfully! Listening for updates...")
 
-    # Set webhook
-    await application.bot.set_webhook(webhook_url)
+async def on_shutdown(application):
+    """Release everything on_startup created (post_shutdown hook)"""
+    cleanup_task = application.bot_data.get('cleanup_task')
+    if cleanup_task:
+        cleanup_task.cancel()
+    web_runner = application.bot_data.get('web_runner')
+    if web_runner:
+        await web_runner.cleanup()
+    gh_session.close()
 
-    print("📡 Webhook set successfully! Starting webhook listener...")
+BANNER_RULE = "=" * 50
+STARTUP_BANNER = "\n".join([
+    "",
+    BANNER_RULE,
+    "🤖 STARTING BOT ON KOYEB USING WEBHOOKS",
+    BANNER_RULE,
+    f"🔗 Bot token: {TELEGRAM_BOT_TOKEN[:10]}...",
+    f"🌐 GitHub Repo: {GITHUB_REPO_OWNER}/{GITHUB_REPO_NAME}",
+    f"📁 Data file: {GITHUB_FILE_PATH}",
+    "⚡ Mode: Webhook",
+    BANNER_RULE
+])
 
-    # Start webhook listener
-    await application.run_webhook(
-        listen="0.0.0.0",
-        port=port,
-        url_path=TELEGRAM_BOT_TOKEN,
-        webhook_url=webhook_url
-    )
+async def main():
+    # One log record (and one write) for the whole banner
+    logger.info(STARTUP_BANNER)
+
+    # Build bot application
+    application = await setup_application()
+
+    # run_webhook stops on SIGINT/SIGTERM; asyncio.run doesn't, and Koyeb sends
+    # SIGTERM, so without this on_shutdown and the log flush would never run
+    stop_event = asyncio.Event()
+    if sys.platform != "win32":
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    # Same order as Application.run_webhook: initialize, post_init, start ...
+    # stop the web server, stop, shutdown, post_shutdown
+    try:
+        async with application:
+            await application.post_init(application)
+            await application.start()
+            try:
+                await stop_event.wait()
+            finally:
+                # Stop taking webhook requests before stop() waits for running
+                # handlers, otherwise updates accepted meanwhile would be dropped
+                web_runner = application.bot_data.pop('web_runner', None)
+                if web_runner:
+                    await web_runner.cleanup()
+                await application.stop()
+    finally:
+        await application.post_shutdown(application)
 
 
 # ========== ENTRY POINT ==========
 if __name__ == "__main__":
-    print("🚀 Launching Telegram bot with Webhook mode on Koyeb")
+    logger.info("🚀 Launching Telegram bot with Webhook mode on Koyeb")
     try:
-        asyncio.run(main())
+        # Prefer the libuv-based event loop where available
+        if uvloop:
+            uvloop.run(main())
+        else:
+            if sys.platform == "win32":
+                asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+            asyncio.run(main())
     except Exception as e:
-        print(f"❌ Unexpected error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception(f"❌ Unexpected error: {e}")